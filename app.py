@@ -1,22 +1,38 @@
 #!/usr/bin/python3
 
+import argparse
 import configparser
 import json
+import marshal
 import os
+import random
 import re
+import select
 import shutil
+import struct
 import sys
 import time
 import zipfile
+import zlib
 
-from func import download, md5
-from rsync import sync
+from func import (archive, cached, cached_path, configure, connections, count, download, download_file, iterate,
+                  md5, measure, release, report, signature, store_get, store_put, store_release)
+from rsync import copies, sync
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_EVENTS = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
 
 
 class AddOn:
-    def __init__(self):
-        self.name = None
-        self.version = None
+    __slots__ = ('name', 'version', 'path')
+
+    def __init__(self, name=None, version=None):
+        self.name = name
+        self.version = version
         self.path = None
 
 
@@ -26,6 +42,90 @@ class SortedDict(dict):
         return sorted(super().items(), key=key)
 
 
+class Watcher:
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.state = self.scan()
+
+        if sys.platform.startswith('linux'):
+            try:
+                import ctypes
+
+                libc = ctypes.CDLL(None, use_errno=True)
+
+                fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+                if fd < 0:
+                    raise OSError(ctypes.get_errno(), 'inotify_init1')
+
+                if libc.inotify_add_watch(fd, os.fsencode(path), IN_EVENTS) < 0:
+                    os.close(fd)
+
+                    raise OSError(ctypes.get_errno(), 'inotify_add_watch')
+
+                self.fd = fd
+
+            except (OSError, AttributeError):
+                self.fd = None
+
+    def scan(self):
+        result = {}
+
+        for path in sorted(os.listdir(self.path)):
+            if not path.endswith('.zip'):
+                continue
+
+            try:
+                result[path] = signature(self.path + '/' + path)
+
+            except OSError:
+                pass
+
+        return result
+
+    def changed(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+
+            return self.scan() != self.state
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+
+        result = False
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+
+            except BlockingIOError:
+                return result
+
+            offset = 0
+            while offset < len(data):
+                size = struct.unpack_from('iIII', data, offset)[3]
+                name = data[offset + 16:offset + 16 + size].rstrip(b'\0')
+
+                if name.endswith(b'.zip'):
+                    result = True
+
+                offset += 16 + size
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+
+        while (remaining := deadline - time.monotonic()) > 0:
+            if self.changed(min(remaining, watch_poll_interval)):
+                while self.changed(1):
+                    self.state = self.scan()
+
+                self.state = self.scan()
+
+                return True
+
+        return False
+
+
 def key(item):
     return item[1] if item[0].isnumeric() and type(item[1]) is str else item[0]
 
@@ -34,138 +134,364 @@ def log(status, kind, uid, message):
     print('\t%s\t%s\t%s\t%s' % (status, kind, uid, message))
 
 
-def dependencies(path):
-    z = zipfile.ZipFile(path)
+def scan(path):
+    depends = []
 
-    for name in z.namelist():
-        info = z.getinfo(name)
+    a = archive(path)
 
-        if info.is_dir() or not name.endswith('.txt'):
+    for info in a.infos:
+        if info.is_dir() or not info.filename.endswith('.txt'):
             continue
 
-        with z.open(name) as f:
+        with a.zip_file.open(info) as f:
             lines = f.readlines()
 
         for line in lines:
             text = line.decode('utf-8', errors='ignore')
             if text.startswith('## DependsOn:'):
                 for directory in re.sub(r'[=<>][^ ]+', '', text).strip().split()[2:]:
-                    if directory in satisfied:
-                        continue
+                    if directory not in depends:
+                        depends.append(directory)
+
+    return {'depends': depends, 'provides': sorted(a.provides)}
 
-                    if any(path.endswith(directory + '/' + directory + '.txt') for path in z.namelist()):
-                        satisfied.add(directory)
 
-                        continue
+def dependencies(path, digest):
+    result = []
+
+    if digest not in graph['archives']:
+        with measure('scan'):
+            graph['archives'][digest] = scan(path)
+
+    digests.add(digest)
+
+    node = graph['archives'][digest]
+    provides = set(node['provides'])
+
+    for directory in node['depends']:
+        if directory in satisfied:
+            continue
+
+        if directory in provides:
+            satisfied.add(directory)
+
+            continue
+
+        if directory in candidates:
+            satisfied.add(directory)
 
-                    if directory in candidates:
-                        satisfied.add(directory)
+            if len(candidates[directory]) < 2:
+                result.append(candidates[directory][0])
 
-                        if len(candidates[directory]) < 2:
-                            process(candidates[directory][0])
+            else:
+                if directory not in c['SelectedLibraries'] or c['SelectedLibraries'][
+                    directory] not in candidates[directory]:
+                    c['SelectedLibraries'][directory] = candidates[directory][0]
 
-                        else:
-                            if directory not in c['SelectedLibraries'] or c['SelectedLibraries'][
-                                directory] not in candidates:
-                                c['SelectedLibraries'][directory] = candidates[directory][0]
+                result.append(c['SelectedLibraries'][directory])
 
-                            process(c['SelectedLibraries'][directory])
+            continue
 
-                        continue
+        else:
+            log('err', 'lib', '-', 'No candidates found for %s' % directory)
 
-                    else:
-                        log('err', 'lib', '-', 'No candidates found for %s' % directory)
+    return result
 
 
-def process(uid):
+def check(uid, section):
     name = database[uid].name
     version = database[uid].version
 
     identifier = re.sub(r'\W', '', name) + '_' + uid
     path = 'addons/' + identifier + '.zip'
 
-    invalid = not os.path.exists(path) or not c.has_section(uid) or c[uid].get('UIVersion') != version or c[uid].get(
-        'UIMD5') != md5(path)
+    known = section.get('Stat'), section.get('UIMD5')
+
+    with measure('check'):
+        invalid = not os.path.exists(path) or section.get('UIVersion') != version or \
+            section.get('UIMD5') != md5(path, known)
+
     if invalid:
-        obj_list = json.loads(download(api_url_prefix + '/filedetails/' + uid + '.json'))
-        obj = obj_list[0]
+        return path, True, None
+
+    return path, False, signature(path)
+
+
+def describe(uids):
+    result = {}
+
+    if len(uids) > 1:
+        try:
+            for obj in json.loads(download(api_url_prefix + '/filedetails/' + ','.join(uids) + '.json', cache=True)):
+                result[str(obj['UID'])] = obj
+
+        except (OSError, ValueError, KeyError):
+            result = {}
+
+    for uid in uids:
+        if uid not in result:
+            obj_list = json.loads(download(api_url_prefix + '/filedetails/' + uid + '.json', cache=True))
+            result[uid] = obj_list[0]
+
+    return result
+
+
+def batches(uids):
+    return [uids[i:i + batch_size] for i in range(0, len(uids), batch_size)]
+
+
+def fetch(uid, checked, obj):
+    path, invalid, stat = checked
+
+    warnings = []
+
+    if invalid:
+        try:
+            stored = store_get(obj['UIMD5'], path)
+
+        except OSError as e:
+            stored = None
 
+            warnings.append('Shared store (%s)' % e)
+
+        if not stored:
+            try:
+                download_file(obj['UIDownload'], path, obj['UIMD5'])
+
+            except (OSError, ValueError) as e:
+                return path, 'err', e, None, warnings
+
+            try:
+                if stored is not None:
+                    store_put(obj['UIMD5'], path)
+
+            except OSError as e:
+                warnings.append('Shared store (%s)' % e)
+
+        return path, 'upd', obj, signature(path), warnings
+
+    return path, '-', None, stat, warnings
+
+
+def pending(uids):
+    result = sorted(set(uids) - processed, key=int)
+    processed.update(result)
+
+    return result
+
+
+def snapshot(uid):
+    return dict(c[uid]) if c.has_section(uid) else {}
+
+
+def settle(uid, result):
+    path, status, obj, stat, warnings = result
+
+    kind = 'lib' if uid not in addons else '-'
+
+    if status == 'err':
+        log(status, kind, uid, '%s (%s)' % (database[uid].name, obj))
+
+        for warning in warnings:
+            log('wrn', kind, uid, warning)
+
+        failed.add(path)
+
+        if not os.path.exists(path):
+            return []
+
+    else:
         if not c.has_section(uid):
             c.add_section(uid)
 
-        c[uid]['UIVersion'] = obj['UIVersion']
-        c[uid]['UIMD5'] = obj['UIMD5']
+        if status == 'upd':
+            c[uid]['UIVersion'] = obj['UIVersion']
+            c[uid]['UIMD5'] = obj['UIMD5']
 
-        body = download(obj['UIDownload'])
-        with open(path, 'wb') as f:
-            f.write(body)
+        c[uid]['Stat'] = stat
 
-    status = 'upd' if invalid else '-'
-    kind = 'lib' if uid not in addons else '-'
-    log(status, kind, uid, name)
+        log(status, kind, uid, database[uid].name)
+
+        for warning in warnings:
+            log('wrn', kind, uid, warning)
 
     sources.add(path)
 
-    dependencies(path)
+    if status == 'err':
+        digest = md5(path)
+
+    else:
+        digest = c[uid]['UIMD5']
+
+    return dependencies(path, digest)
+
+
+def waves(uids):
+    while uids:
+        uids = pending(uids)
+
+        checks = yield check, uids, [snapshot(uid) for uid in uids]
+        stale = [uid for uid, checked in zip(uids, checks) if checked[1]]
+
+        details = {}
+        for result in (yield describe, batches(stale)):
+            details |= result
+
+        results = yield fetch, uids, checks, [details.get(uid) for uid in uids]
+
+        found = []
+
+        for uid, result in zip(uids, results):
+            found.extend(settle(uid, result))
+
+        uids = found
+
+
+def process(uids):
+    import concurrent.futures
+
+    steps = waves(uids)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        try:
+            step = next(steps)
+            while True:
+                step = steps.send(list(executor.map(*step)))
+
+        except StopIteration:
+            pass
+
+
+async def gather(executor, function, *iterables):
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+
+    return await asyncio.gather(*[loop.run_in_executor(executor, function, *args) for args in zip(*iterables)])
+
+
+async def process_async(uids, executor):
+    steps = waves(uids)
+
+    try:
+        step = next(steps)
+        while True:
+            step = steps.send(await gather(executor, *step))
+
+    except StopIteration:
+        pass
 
 
 def ttc():
-    if '1245' not in addons:
-        return []
+    return ttc_deploy(ttc_update())
 
-    addon_directory = 'TamrielTradeCentre'
-    path = 'ttc/PriceTable.zip'
 
-    os.makedirs(target_directory + '/' + addon_directory, exist_ok=True)
+def ttc_update():
+    with measure('ttc'):
+        if '1245' not in addons:
+            return None
 
-    local_version = None
-    if os.path.exists(path):
-        z = zipfile.ZipFile(path)
-        for name in z.namelist():
-            if name.startswith('PriceTable') and name.endswith('.lua'):
-                with z.open(name) as f:
-                    line = f.readline().decode('utf-8')
-                    if line.startswith('--Version = '):
-                        local_version = int(line.split('=')[-1].strip())
+        path = 'ttc/PriceTable.zip'
 
-    obj = json.loads(download(ttc_url_prefix + '/api/GetTradeClientVersion'))
-    remote_version = obj['PriceTableVersion']
+        local_version = None
+        if os.path.exists(path):
+            a = archive(path)
+            for name in a.names:
+                if name.startswith('PriceTable') and name.endswith('.lua'):
+                    with a.zip_file.open(name) as f:
+                        line = f.readline().decode('utf-8')
+                        if line.startswith('--Version = '):
+                            local_version = int(line.split('=')[-1].strip())
 
-    if local_version != remote_version:
-        price_table = download(ttc_url_prefix + '/Download/PriceTable')
-        with open(path, 'wb') as f:
-            f.write(price_table)
+        obj = json.loads(download(ttc_url_prefix + '/api/GetTradeClientVersion', cache=True,
+                                  max_age=ttc_check_interval))
+        remote_version = obj['PriceTableVersion']
 
-            print('Successfully updated')
-    else:
-        print('Already up to date')
+        if local_version != remote_version:
+            download_file(ttc_url_prefix + '/Download/PriceTable', path)
 
-    sync([path], target_directory + '/' + addon_directory, clean=False)
+            return 'Successfully updated'
 
-    result = []
-    z = zipfile.ZipFile(path)
-    for name in z.namelist():
-        result.append('^' + addon_directory + '/' + name.replace('.', r'\.'))
+        return 'Already up to date'
 
-    return result
 
+def ttc_deploy(message):
+    if message is None:
+        return set()
 
-def run():
-    obj_list = json.loads(download(api_url_prefix + '/filelist.json'))
-    for obj in obj_list:
-        uid = obj['UID']
-        name = obj['UIName']
-        version = obj['UIVersion']
+    print(message)
+
+    with measure('ttc'):
+        addon_directory = 'TamrielTradeCentre'
+        path = 'ttc/PriceTable.zip'
+
+        os.makedirs(target_directory + '/' + addon_directory, exist_ok=True)
+
+        sync([path], target_directory + '/' + addon_directory, clean=False, check_time=False, manifest='cache/ttc.json',
+             trust_manifest=not verify_target, cached_checksums=True)
+
+        result = set()
+        for name in archive(path).names:
+            result.add(addon_directory + '/' + name)
+
+        return result
+
+
+def catalog():
+    global catalog_key
+
+    with measure('catalog'):
+        path = cached_path(api_url_prefix + '/filelist.json')
+        key = signature(path)
+
+        if key == catalog_key:
+            return
+
+        database.clear()
+        candidates.clear()
+
+        entries = None
+        if os.path.exists('cache/catalog.bin'):
+            with open('cache/catalog.bin', 'rb') as f:
+                try:
+                    snapshot = marshal.load(f)
 
-        database[uid] = AddOn()
-        database[uid].name = name
-        database[uid].version = version
+                except (EOFError, ValueError, TypeError):
+                    snapshot = None
 
-        for directory in obj['UIDir']:
-            if directory not in candidates:
-                candidates[directory] = []
+            if snapshot is not None and snapshot[0] == key:
+                entries = snapshot[1]
 
-            candidates[directory].append(uid)
+                count('catalog_snapshot_hits')
+
+        if entries is None:
+            entries = []
+            for obj in iterate(path):
+                entries.append((obj['UID'], obj['UIName'], obj['UIVersion'], tuple(obj['UIDir'])))
+
+            with open('cache/catalog.bin.tmp', 'wb') as f:
+                marshal.dump((key, entries), f)
+
+            os.replace('cache/catalog.bin.tmp', 'cache/catalog.bin')
+
+        for uid, name, version, directories in entries:
+            uid = sys.intern(uid)
+
+            database[uid] = AddOn(name, version)
+
+            for directory in directories:
+                directory = sys.intern(directory)
+
+                if directory not in candidates:
+                    candidates[directory] = []
+
+                candidates[directory].append(uid)
+
+        catalog_key = key
+
+
+def selection():
+    uids = []
 
     for uid in addons.keys():
         if uid in database:
@@ -174,7 +500,7 @@ def run():
 
             addons[uid] = database[uid].name
 
-            process(uid)
+            uids.append(uid)
 
         else:
             name = addons[uid]
@@ -184,18 +510,177 @@ def run():
             else:
                 log('err', '-', uid, 'Not found in database')
 
+    return uids
+
+
+def customs():
+    result = []
+
     for path in sorted(os.listdir('custom')):
         if path.endswith('.zip'):
             path = 'custom/' + path
             if os.path.isfile(path):
-                name = path.removeprefix('custom/').removesuffix('.zip')
-                log('err', '-', '-', 'Custom (%s)' % name)
+                result.append(path)
+
+    return result
+
+
+def custom(path):
+    name = path.removeprefix('custom/').removesuffix('.zip')
+    log('err', '-', '-', 'Custom (%s)' % name)
+
+    sources.add(path)
+
+    digest = md5(path, graph['files'].get(path))
+    graph['files'][path] = signature(path), digest
+
+    return dependencies(path, digest)
+
+
+def deploy(exclude_paths):
+    with measure('deploy'):
+        sync(sources, target_directory, exclude_paths=exclude_paths, manifest='cache/target.json',
+             trust_manifest=not verify_target, cached_checksums=True, staging=True)
+
+
+def run():
+    catalog()
+
+    with measure('addons'):
+        process(selection())
+
+        for path in customs():
+            process(custom(path))
+
+    exclude_paths = ttc()
+
+    deploy(exclude_paths)
+
+    release()
+
+    return exclude_paths
+
+
+async def run_async():
+    import asyncio
+    import concurrent.futures
+
+    loop = asyncio.get_running_loop()
+
+    with concurrent.futures.ThreadPoolExecutor(workers + 1) as executor:
+        updated = loop.run_in_executor(executor, ttc_update)
+
+        try:
+            await loop.run_in_executor(executor, catalog)
+
+            with measure('addons'):
+                await process_async(selection(), executor)
+
+                for path in customs():
+                    await process_async(custom(path), executor)
+
+        except BaseException:
+            updated.cancel()
+
+            await asyncio.gather(updated, return_exceptions=True)
+
+            raise
+
+        exclude_paths = await loop.run_in_executor(executor, ttc_deploy, await updated)
+
+        await loop.run_in_executor(executor, deploy, exclude_paths)
+
+    release()
+
+    return exclude_paths
+
+
+def refresh(exclude_paths):
+    for path in list(sources):
+        if path.startswith('custom/'):
+            sources.remove(path)
+
+    with measure('addons'):
+        for path in customs():
+            process(custom(path))
+
+    deploy(exclude_paths)
+
+    release()
+
+
+def watch(asynchronous=False):
+    global digests, processed, satisfied, sources, failed
+
+    watcher = Watcher('custom')
+
+    while True:
+        if edited():
+            print(' * Reloading app.ini')
+
+            load(verify_target)
+
+        print(' * Update (%s)' % time.strftime('%Y-%m-%d %H:%M:%S'))
+
+        digests = set()
+        processed = set()
+        satisfied = set()
+        sources = set()
+        failed = set()
+
+        cached.clear()
+
+        exclude_paths = set()
+        ready = False
+
+        try:
+            if asynchronous:
+                import asyncio
 
-                sources.add(path)
+                exclude_paths = asyncio.run(run_async())
 
-                dependencies(path)
+            else:
+                exclude_paths = run()
+
+            if edited():
+                continue
+
+            cleanup()
+            save()
+
+            ready = True
+
+        except (OSError, ValueError, KeyError, struct.error, zipfile.BadZipFile, zlib.error) as e:
+            release()
+
+            log('err', '-', '-', e)
+
+        delay = watch_interval + random.uniform(0, watch_jitter)
+        deadline = time.monotonic() + delay
+
+        print(' * Next update at %s' % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() + delay)))
 
-    sync(sources, target_directory, exclude_patterns=ttc())
+        while watcher.wait(deadline - time.monotonic()):
+            if not ready or edited():
+                break
+
+            print(' * Custom (%s)' % time.strftime('%Y-%m-%d %H:%M:%S'))
+
+            try:
+                refresh(exclude_paths)
+
+                if edited():
+                    break
+
+                cleanup()
+                save()
+
+            except (OSError, ValueError, KeyError, struct.error, zipfile.BadZipFile, zlib.error) as e:
+                release()
+
+                log('err', '-', '-', e)
+
+                break
 
 
 def delete(path):
@@ -207,7 +692,9 @@ def delete(path):
 
 def cleanup():
     for path in os.listdir('addons'):
-        if 'addons' + '/' + path not in sources:
+        archive_path = 'addons' + '/' + path.removesuffix('.json').removesuffix('.part')
+
+        if archive_path not in sources and archive_path not in failed:
             delete('addons' + '/' + path)
 
     for path in os.listdir('custom'):
@@ -218,10 +705,30 @@ def cleanup():
         if path != 'PriceTable.zip':
             delete('ttc' + '/' + path)
 
+    try:
+        store_release(digests)
+
+    except OSError as e:
+        log('wrn', '-', '-', 'Shared store (%s)' % e)
+
+    for path in os.listdir('cache/http'):
+        if path.removesuffix('.json') not in cached:
+            delete('cache/http' + '/' + path)
+
+    for digest in list(graph['archives'].keys()):
+        if digest not in digests:
+            del graph['archives'][digest]
+
+    for path in list(graph['files'].keys()):
+        if path not in sources:
+            del graph['files'][path]
+
     for section in c.sections():
         if section == 'General':
             for option in c[section].keys():
-                if option not in {'TargetDirectory'}:
+                if option not in {'TargetDirectory', 'Workers', 'Timeout', 'Retries', 'CacheMaxAge',
+                                  'TTCCheckInterval', 'DetailsBatchSize', 'SharedStore', 'SharedStoreSize',
+                                  'WatchInterval', 'WatchJitter', 'WatchPollInterval'}:
                     c.remove_option(section, option)
         elif section == 'URLPrefixes':
             for option in c[section].keys():
@@ -245,21 +752,32 @@ def cleanup():
 
             else:
                 for option in c[section].keys():
-                    if option not in {'UIVersion', 'UIMD5'}:
+                    if option not in {'UIVersion', 'UIMD5', 'Stat'}:
                         c.remove_option(section, option)
 
 
+def edited():
+    return (os.stat('app.ini').st_mtime_ns if os.path.exists('app.ini') else None) != config_time
+
+
 def save():
+    global config_time
+
     with open('app.ini', 'w') as f:
         c.write(f)
 
+    config_time = os.stat('app.ini').st_mtime_ns
 
-if __name__ == '__main__':
-    start_time = time.time()
-    file_path = os.path.abspath(sys.executable if getattr(sys, 'frozen', False) else __file__)
-    file_directory = os.path.dirname(os.path.abspath(file_path))
+    with open('cache/graph.json.tmp', 'w') as f:
+        json.dump(graph, f)
+
+    os.replace('cache/graph.json.tmp', 'cache/graph.json')
 
-    os.chdir(file_directory)
+
+def load(verify=False):
+    global c, target_directory, workers, batch_size, api_url_prefix, ttc_url_prefix, ttc_check_interval, addons, \
+        database, candidates, graph, digests, processed, satisfied, sources, failed, catalog_key, watch_interval, \
+        watch_jitter, watch_poll_interval, verify_target, config_time
 
     c = configparser.ConfigParser(dict_type=SortedDict)
     c.optionxform = str
@@ -268,33 +786,144 @@ if __name__ == '__main__':
     c.add_section('AddOns')
     c.add_section('SelectedLibraries')
     c['General']['TargetDirectory'] = 'target/AddOns'
+    c['General']['Workers'] = '8'
+    c['General']['Timeout'] = '60'
+    c['General']['Retries'] = '3'
+    c['General']['CacheMaxAge'] = '0'
+    c['General']['TTCCheckInterval'] = '3600'
+    c['General']['DetailsBatchSize'] = '20'
+    c['General']['SharedStore'] = ''
+    c['General']['SharedStoreSize'] = '0'
+    c['General']['WatchInterval'] = '3600'
+    c['General']['WatchJitter'] = '300'
+    c['General']['WatchPollInterval'] = '5'
     c['URLPrefixes']['API'] = 'https://api.mmoui.com/v3/game/ESO'
     c['URLPrefixes']['TTC'] = 'https://eu.tamrieltradecentre.com'
 
+    config_time = None
+
     if os.path.exists('app.ini'):
+        config_time = os.stat('app.ini').st_mtime_ns
+
         c.read('app.ini')
 
     target_directory = c['General']['TargetDirectory']
+    workers = max(1, c['General'].getint('Workers'))
+    timeout = c['General'].getfloat('Timeout')
+    retries = c['General'].getint('Retries')
+    cache_max_age = c['General'].getfloat('CacheMaxAge')
+    ttc_check_interval = c['General'].getfloat('TTCCheckInterval')
+    batch_size = max(1, c['General'].getint('DetailsBatchSize'))
+    store_directory = c['General']['SharedStore'] or None
+    store_limit = c['General'].getint('SharedStoreSize') * 1024 * 1024
+    watch_interval = c['General'].getfloat('WatchInterval')
+    watch_jitter = c['General'].getfloat('WatchJitter')
+    watch_poll_interval = max(0.1, c['General'].getfloat('WatchPollInterval'))
     api_url_prefix = c['URLPrefixes']['API']
     ttc_url_prefix = c['URLPrefixes']['TTC']
 
+    verify_target = verify
+
+    configure(timeout=(min(timeout, 10), timeout), retries=retries, pool_size=workers, cache_max_age=cache_max_age,
+              verify=verify, store_directory=store_directory, store_limit=store_limit)
+
     os.makedirs(target_directory, exist_ok=True)
 
     os.makedirs('addons', exist_ok=True)
     os.makedirs('custom', exist_ok=True)
     os.makedirs('ttc', exist_ok=True)
+    os.makedirs('cache/http', exist_ok=True)
+
+    if store_directory is not None:
+        try:
+            os.makedirs(store_directory, exist_ok=True)
+
+        except OSError as e:
+            log('wrn', '-', '-', 'Shared store (%s)' % e)
 
     addons = c['AddOns']
 
     database = {}
     candidates = {}
+    catalog_key = None
+
+    graph = {'archives': {}, 'files': {}}
+    if os.path.exists('cache/graph.json'):
+        with open('cache/graph.json', 'r') as f:
+            try:
+                graph |= json.load(f)
+
+            except ValueError:
+                pass
+
+    digests = set()
 
+    processed = set()
     satisfied = set()
     sources = set()
+    failed = set()
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--verify', action='store_true',
+                        help='re-hash every archive and re-check the target instead of trusting app.ini and manifests')
+    parser.add_argument('--async', dest='asynchronous', action='store_true',
+                        help='overlap the TTC update with the add-on fetches on one event loop')
+    parser.add_argument('--report', metavar='PATH', help='write phase timings and I/O counters as JSON')
+    parser.add_argument('--profile', metavar='PATH', help='write cProfile stats of the run')
+    parser.add_argument('--watch', action='store_true',
+                        help='stay resident, update every WatchInterval seconds and sync custom/ when it changes')
+    args = parser.parse_args()
+
+    file_path = os.path.abspath(sys.executable if getattr(sys, 'frozen', False) else __file__)
+    file_directory = os.path.dirname(os.path.abspath(file_path))
+
+    os.chdir(file_directory)
+
+    load(args.verify)
+
+    if args.watch:
+        try:
+            watch(args.asynchronous)
+
+        except KeyboardInterrupt:
+            pass
+
+        sys.exit()
+
+    profile = None
+    if args.profile:
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+
+    with measure('run'):
+        if args.asynchronous:
+            import asyncio
+
+            asyncio.run(run_async())
+
+        else:
+            run()
+
+    with measure('cleanup'):
+        cleanup()
+        save()
+
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(args.profile)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(dict(report(), copies=copies(), time=time.time() - start_time), f, indent=2, sort_keys=True)
 
-    run()
-    cleanup()
-    save()
+    for host, counters in sorted(connections().items()):
+        print(' * %s - %d connections opened, %d reused' % (host, counters['opened'], counters['reused']))
 
     print(' * Done (%s) - %.2fs' % (__file__, time.time() - start_time))
 
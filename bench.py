@@ -0,0 +1,488 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import datetime
+import hashlib
+import http.server
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import app
+import func
+from rsync import Info, Sync, timestamp, timestamps
+
+
+def legacy_tree(source):
+    cut = len(source) + 1
+
+    result = {}
+
+    for dir_path, dir_names, file_names in os.walk(source):
+        dir_path = dir_path.replace(os.sep, '/')
+        short_path = dir_path[cut:]
+        if short_path:
+            short_path += '/'
+
+        for dir_name in sorted(dir_names):
+            result[short_path + dir_name + '/'] = Info()
+
+        for file_name in sorted(file_names):
+            info = Info()
+            info.source = source
+            info.modified = int(os.path.getmtime(dir_path + '/' + file_name))
+            info.size = os.path.getsize(dir_path + '/' + file_name)
+
+            result[short_path + file_name] = info
+
+    for path in sorted(result.keys()):
+        while True:
+            path = os.path.dirname(path.rstrip('/')) + '/'
+
+            if path == '/':
+                break
+
+            if path not in result:
+                result[path] = Info()
+
+    return result
+
+
+def make_tree(directory, files, per_directory=50, per_addon=200):
+    for i in range(files):
+        addon = 'AddOn%04d' % (i // per_addon)
+        path = '%s/%s/Part%02d' % (directory, addon, (i % per_addon) // per_directory)
+
+        os.makedirs(path, exist_ok=True)
+
+        with open('%s/File%05d.lua' % (path, i), 'wb') as f:
+            f.write(b'-' * (i % 512))
+
+
+def measure(function, repeat):
+    stat = os.stat
+    calls = [0]
+
+    def counted_stat(*args, **kwargs):
+        calls[0] += 1
+
+        return stat(*args, **kwargs)
+
+    os.stat = counted_stat
+
+    entries = func.metrics.get('files_stated', 0)
+
+    try:
+        start_time = time.perf_counter()
+
+        for _ in range(repeat):
+            result = function()
+
+        elapsed = (time.perf_counter() - start_time) / repeat
+
+    finally:
+        os.stat = stat
+
+    calls[0] += func.metrics.get('files_stated', 0) - entries
+
+    return result, calls[0] // repeat, elapsed
+
+
+def tree(args):
+    directory = tempfile.mkdtemp()
+
+    try:
+        make_tree(directory, args.files)
+
+        task = Sync()
+
+        for threads in sorted({1, args.threads}):
+            task.threads = threads
+
+            legacy, legacy_calls, legacy_time = measure(lambda: legacy_tree(directory), args.repeat)
+            result, calls, elapsed = measure(lambda: task._Sync__tree(directory), args.repeat)
+
+            assert sorted(legacy.keys()) == sorted(result.keys())
+            assert all(legacy[path].size == result[path].size for path in result.keys())
+
+            files = sum(1 for path in result.keys() if not path.endswith('/'))
+            scale = 10000 / files
+
+            print('threads: %d, files: %d' % (threads, files))
+            print('\tos.walk:\t%d stat calls, %.1f ms per 10k files' % (legacy_calls * scale, legacy_time * 1000 * scale))
+            print('\tos.scandir:\t%d stat calls, %.1f ms per 10k files' % (calls * scale, elapsed * 1000 * scale))
+
+    finally:
+        shutil.rmtree(directory)
+
+
+def legacy_timestamp(date_time):
+    modified_str = '%d-%02d-%02d %02d:%02d:%02d' % date_time
+    modified_datetime = datetime.datetime.strptime(modified_str, '%Y-%m-%d %H:%M:%S')
+
+    return int(time.mktime(modified_datetime.timetuple()))
+
+
+def zip_tree(args):
+    directory = tempfile.mkdtemp()
+
+    try:
+        path = directory + '/archive.zip'
+
+        with zipfile.ZipFile(path, 'w') as z:
+            for i in range(args.files):
+                date_time = (2024, 1 + i % 12, 1 + i % args.timestamps % 28, i % args.timestamps % 24, 0, 0)
+
+                z.writestr(zipfile.ZipInfo('AddOn%04d/File%05d.lua' % (i // 200, i), date_time), b'')
+
+        infos = zipfile.ZipFile(path).infolist()
+
+        legacy = [legacy_timestamp(i.date_time) for i in infos]
+        assert legacy == [timestamp(i.date_time) for i in infos]
+
+        task = Sync()
+
+        for name, function in (
+                ('strptime', lambda: [legacy_timestamp(i.date_time) for i in infos]),
+                ('memoized', lambda: [timestamp(i.date_time) for i in infos]),
+                ('Sync.__tree', lambda: task._Sync__tree(path)),
+        ):
+            start_time = time.perf_counter()
+
+            for _ in range(args.repeat):
+                timestamps.clear()
+                function()
+
+            elapsed = (time.perf_counter() - start_time) / args.repeat
+
+            print('%s:\t%.1f ms per %d entries' % (name, elapsed * 1000, len(infos)))
+
+    finally:
+        shutil.rmtree(directory)
+
+
+def import_time(statement):
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+    total = 0
+    modules = {}
+
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line.removeprefix('import time:').split('|')
+
+        if not name.startswith('  '):
+            total += int(cumulative)
+
+        modules[name.strip()] = modules.get(name.strip(), 0) + int(cumulative)
+
+    return total, modules
+
+
+def startup(args):
+    baseline = min(import_time('pass')[0] for _ in range(args.repeat))
+
+    for statement in ('import app', 'import app, asyncio, requests'):
+        total, modules = min((import_time(statement) for _ in range(args.repeat)), key=lambda x: x[0])
+
+        print('%s:\t%.1f ms, %.1f ms over a bare interpreter' % (statement, total / 1000, (total - baseline) / 1000))
+
+        for name, cumulative in sorted(modules.items(), key=lambda x: x[1], reverse=True)[:args.top]:
+            print('\t%-32s%.1f ms' % (name, cumulative / 1000))
+
+
+class Catalog:
+    def __init__(self, addons, files):
+        self.addons = {}
+        self.price_table_version = 1
+        self.zips = {}
+        self.lock = threading.Lock()
+
+        for i in range(1, addons + 1):
+            uid = str(i)
+
+            if i % 10 == 0:
+                name = 'Lib%04d' % i
+                depends = []
+
+            else:
+                name = 'AddOn%04d' % i
+                depends = ['Lib%04d' % (j * 10) for j in {i // 10 + 1, i % 7 + 1} if j * 10 <= addons]
+
+            self.addons[uid] = {'name': name, 'version': 1, 'files': files, 'depends': depends}
+
+        self.addons['1245'] = {'name': 'TamrielTradeCentre', 'version': 1, 'files': 3, 'depends': []}
+
+    def patch(self, fraction):
+        with self.lock:
+            for i, addon in enumerate(self.addons.values()):
+                if i % round(1 / fraction) == 0:
+                    addon['version'] += 1
+
+            self.price_table_version += 1
+
+    def archive(self, uid):
+        addon = self.addons[uid]
+        key = uid, addon['version']
+
+        with self.lock:
+            if key not in self.zips:
+                name = addon['name']
+
+                files = {name + '/' + name + '.txt': '## Title: %s\n## DependsOn: %s\n' % (name, ' '.join(addon['depends']))}
+                for i in range(addon['files'] - 1):
+                    version = addon['version'] if i == 0 else 1
+                    files['%s/Part%02d/File%04d.lua' % (name, i // 50, i)] = '-- %s %d %d\n' % (name, version, i) * (i % 40 + 10)
+
+                self.zips[key] = make_zip(files, (2024, 1, 1, 0, 0, 0))
+
+            return self.zips[key]
+
+    def respond(self, path):
+        if path == '/api/filelist.json':
+            body = [{'UID': uid, 'UIName': addon['name'], 'UIVersion': str(addon['version']), 'UIDir': [addon['name']]}
+                    for uid, addon in self.addons.items()]
+            body = json.dumps(body).encode('utf-8')
+
+            return body, hashlib.md5(body).hexdigest()
+
+        if path.startswith('/api/filedetails/'):
+            body = []
+            for uid in path.removeprefix('/api/filedetails/').removesuffix('.json').split(','):
+                body.append({
+                    'UID': uid,
+                    'UIVersion': str(self.addons[uid]['version']),
+                    'UIMD5': hashlib.md5(self.archive(uid)).hexdigest(),
+                    'UIDownload': '/files/%s-%d.zip' % (uid, self.addons[uid]['version']),
+                })
+
+            return json.dumps(body).encode('utf-8'), None
+
+        if path.startswith('/files/'):
+            uid = path.removeprefix('/files/').split('-')[0]
+
+            return self.archive(uid), None
+
+        if path == '/ttc/api/GetTradeClientVersion':
+            return json.dumps({'PriceTableVersion': self.price_table_version}).encode('utf-8'), None
+
+        if path == '/ttc/Download/PriceTable':
+            files = {}
+            for region in ('EU', 'NA'):
+                lines = ['--Version = %d\n' % self.price_table_version]
+                lines += ['{%d, %d},\n' % (i, i * self.price_table_version) for i in range(20000)]
+                files['PriceTable%s.lua' % region] = ''.join(lines)
+
+            return make_zip(files, (2024, 1, 1, 0, 0, 0)), None
+
+        return None, None
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+
+        path = self.path.removeprefix(self.server.prefix)
+
+        body, etag = self.server.catalog.respond(path)
+
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+            return
+
+        if path.startswith('/api/filedetails/'):
+            body = body.replace(b'"/files/', ('"' + self.server.url + '/files/').encode('utf-8'))
+
+        with self.server.lock:
+            self.server.requests += 1
+
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+
+        for i in range(0, len(body), 64 * 1024):
+            chunk = body[i:i + 64 * 1024]
+
+            if self.server.bandwidth:
+                time.sleep(len(chunk) / self.server.bandwidth)
+
+            self.wfile.write(chunk)
+
+        with self.server.lock:
+            self.server.bytes += len(body)
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, catalog, latency, bandwidth):
+        super().__init__(('127.0.0.1', 0), Handler)
+
+        self.catalog = catalog
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.prefix = ''
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def make_zip(files, date_time):
+    buffer = io.BytesIO()
+
+    with zipfile.ZipFile(buffer, 'w') as z:
+        for name, data in files.items():
+            z.writestr(zipfile.ZipInfo(name, date_time), data, compress_type=zipfile.ZIP_DEFLATED)
+
+    return buffer.getvalue()
+
+
+def update(directory, server, workers):
+    timings = {'sync': 0}
+
+    def timed_sync(*args, **kwargs):
+        start_time = time.perf_counter()
+
+        try:
+            sync(*args, **kwargs)
+
+        finally:
+            timings['sync'] += time.perf_counter() - start_time
+
+    sync = app.sync
+    current_directory = os.getcwd()
+
+    requests, received = server.requests, server.bytes
+
+    os.chdir(directory)
+    app.sync = timed_sync
+
+    try:
+        if not os.path.exists('app.ini'):
+            with open('app.ini', 'w') as f:
+                f.write('[General]\nWorkers = %d\n\n[URLPrefixes]\nAPI = %s/api\nTTC = %s/ttc\n\n[AddOns]\n' % (
+                    workers, server.url, server.url))
+
+                for uid, addon in server.catalog.addons.items():
+                    if not addon['name'].startswith('Lib'):
+                        f.write('%s =\n' % uid)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.load()
+
+            start_time = time.perf_counter()
+            app.run()
+            timings['run'] = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            app.cleanup()
+            app.save()
+            timings['cleanup'] = time.perf_counter() - start_time
+
+    finally:
+        app.sync = sync
+        os.chdir(current_directory)
+
+    timings['requests'] = server.requests - requests
+    timings['bytes'] = server.bytes - received
+
+    return timings
+
+
+def run(args):
+    print('scale\tscenario\trun\tsync\tcleanup\trequests\tbytes')
+
+    for scale in args.scales:
+        catalog = Catalog(scale, args.files)
+        server = Server(catalog, args.latency, args.bandwidth)
+        directory = tempfile.mkdtemp()
+
+        try:
+            scenarios = [('cold', None), ('warm', None), ('patch-day', args.patch)]
+
+            for name, fraction in scenarios:
+                if fraction:
+                    catalog.patch(fraction)
+
+                timings = update(directory, server, args.workers)
+
+                print('%d\t%s\t%.2fs\t%.2fs\t%.2fs\t%d\t%d' % (
+                    scale, name, timings['run'], timings['sync'], timings['cleanup'], timings['requests'],
+                    timings['bytes']))
+
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_tree = subparsers.add_parser('tree', help='Sync tree scan of a directory source')
+    parser_tree.add_argument('--files', type=int, default=10000)
+    parser_tree.add_argument('--threads', type=int, default=os.cpu_count())
+    parser_tree.add_argument('--repeat', type=int, default=3)
+    parser_tree.set_defaults(function=tree)
+
+    parser_zip = subparsers.add_parser('zip', help='timestamp conversion of zip entries')
+    parser_zip.add_argument('--files', type=int, default=40000)
+    parser_zip.add_argument('--timestamps', type=int, default=20, help='distinct timestamps in the archive')
+    parser_zip.add_argument('--repeat', type=int, default=5)
+    parser_zip.set_defaults(function=zip_tree)
+
+    parser_startup = subparsers.add_parser('startup', help='import time of app.py (-X importtime)')
+    parser_startup.add_argument('--repeat', type=int, default=5)
+    parser_startup.add_argument('--top', type=int, default=10, help='modules to list')
+    parser_startup.set_defaults(function=startup)
+
+    parser_run = subparsers.add_parser('run', help='cold, warm and patch-day updates against a local stand-in server')
+    parser_run.add_argument('--scales', type=lambda x: [int(i) for i in x.split(',')], default=[10, 200, 1000])
+    parser_run.add_argument('--files', type=int, default=40, help='files per add-on')
+    parser_run.add_argument('--latency', type=float, default=0.02, help='seconds added to every request')
+    parser_run.add_argument('--bandwidth', type=float, default=0, help='bytes per second, 0 for unlimited')
+    parser_run.add_argument('--patch', type=float, default=0.2, help='fraction of add-ons updated on patch day')
+    parser_run.add_argument('--workers', type=int, default=8)
+    parser_run.set_defaults(function=run)
+
+    args = parser.parse_args()
+    args.function(args)
@@ -1,24 +1,585 @@
 #!/usr/bin/python3
 
+import contextlib
 import hashlib
-
-import requests
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+import zipfile
 
 block_size = 512 * 1024
 
+timeout = (10, 60)
+retries = 3
+backoff = 0.5
+pool_size = 10
+
+verify = False
+
+cache_directory = 'cache/http'
+cache_max_age = 0
+
+store_directory = None
+store_limit = 0
+store_thread_lock = threading.Lock()
+cached = set()
+
+pools = {}
+limits = {}
+
+archives = {}
+archives_lock = threading.Lock()
+
+session = None
+session_lock = threading.Lock()
+
+metrics = {}
+phases = {}
+metrics_lock = threading.Lock()
+
+
+class Archive:
+    def __init__(self, path):
+        self.path = path
+        self.zip_file = zipfile.ZipFile(path)
+        self.infos = self.zip_file.infolist()
+        self.names = [info.filename for info in self.infos]
+        self.manifests = set()
+        self.provides = set()
+
+        for name in self.names:
+            parts = name.split('/')
+            if len(parts) > 1 and parts[-1] == parts[-2] + '.txt':
+                self.manifests.add(name)
+                self.provides.add(parts[-2])
+
+
+def get_adapter():
+    import requests.adapters
+
+    class Adapter(requests.adapters.HTTPAdapter):
+        def get_connection_with_tls_context(self, request, *args, **kwargs):
+            pool = super().get_connection_with_tls_context(request, *args, **kwargs)
+
+            with session_lock:
+                pools[urllib.parse.urlsplit(request.url).netloc] = pool
+
+            return pool
+
+    return Adapter
+
+
+def archive(path):
+    stat = os.stat(path)
+    key = stat.st_size, stat.st_mtime_ns
+
+    with archives_lock:
+        if path in archives:
+            if archives[path][0] == key:
+                count('zips_reused')
+
+                return archives[path][1]
+
+            archives.pop(path)[1].zip_file.close()
+
+        count('zips_opened')
+
+        result = Archive(path)
+        archives[path] = key, result
+
+        return result
+
+
+def release(path=None):
+    with archives_lock:
+        for key in list(archives.keys()):
+            if path is None or key == path:
+                archives.pop(key)[1].zip_file.close()
+
+
+def configure(**kwargs):
+    global session
+
+    for key in kwargs:
+        globals()[key]
+        globals()[key] = kwargs[key]
+
+    session = None
+    limits.clear()
+
+
+def get_session():
+    global session
+
+    with session_lock:
+        if session is None:
+            import requests
+            import urllib3.util
+
+            retry = urllib3.util.Retry(
+                total=retries,
+                connect=retries,
+                read=retries,
+                status=retries,
+                backoff_factor=backoff,
+                status_forcelist=(500, 502, 503, 504),
+                raise_on_status=False,
+            )
+
+            adapter = get_adapter()(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+        return session
+
+
+def limit(url):
+    host = urllib.parse.urlsplit(url).netloc
+
+    with session_lock:
+        if host not in limits:
+            limits[host] = threading.BoundedSemaphore(pool_size)
+
+        return limits[host]
+
+
+def connections():
+    result = {}
+
+    with session_lock:
+        for host, pool in pools.items():
+            result[host] = {
+                'opened': pool.num_connections,
+                'reused': pool.num_requests - pool.num_connections,
+            }
+
+    return result
+
+
+def count(name, value=1):
+    with metrics_lock:
+        metrics[name] = metrics.get(name, 0) + value
+
+
+@contextlib.contextmanager
+def measure(name):
+    start_time = time.perf_counter()
+
+    try:
+        yield
+
+    finally:
+        elapsed = time.perf_counter() - start_time
+
+        with metrics_lock:
+            entry = phases.setdefault(name, {'calls': 0, 'time': 0})
+            entry['calls'] += 1
+            entry['time'] += elapsed
+
+
+def report():
+    with metrics_lock:
+        result = {
+            'phases': {name: dict(entry) for name, entry in phases.items()},
+            'counters': dict(metrics),
+        }
+
+    result['connections'] = connections()
+
+    return result
+
+
+def download(url, cache=False, max_age=None):
+    if not cache:
+        with measure('download'), limit(url):
+            response = get_session().get(url, timeout=timeout)
+
+        response.raise_for_status()
+
+        count('bytes_fetched', len(response.content))
+
+        return response.content
+
+    with open(cached_path(url, max_age), 'rb') as f:
+        return f.read()
+
+
+def cached_path(url, max_age=None):
+    name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    body_path = cache_directory + '/' + name
+    meta_path = cache_directory + '/' + name + '.json'
+
+    with session_lock:
+        cached.add(name)
+
+    meta = None
+    if os.path.exists(body_path) and os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+
+        if meta.get('url') != url:
+            meta = None
+
+    if max_age is None:
+        max_age = cache_max_age
+
+    headers = {}
+    if meta is not None:
+        if time.time() - meta['time'] < max_age:
+            count('http_cache_fresh')
+
+            return body_path
+
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    with measure('download'), limit(url), \
+            get_session().get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304 and meta is not None:
+            count('http_cache_revalidated')
+
+        else:
+            response.raise_for_status()
+
+            with open(body_path + '.tmp', 'wb') as f:
+                for data in response.iter_content(block_size):
+                    f.write(data)
+
+                    count('bytes_fetched', len(data))
+                    count('bytes_written', len(data))
+
+            os.replace(body_path + '.tmp', body_path)
+
+            meta = {
+                'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+
+    meta['time'] = time.time()
+
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+
+    os.replace(meta_path + '.tmp', meta_path)
+
+    return body_path
+
+
+def iterate(path):
+    decoder = json.JSONDecoder()
+
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ''
+        position = 0
+        started = False
+
+        while True:
+            chunk = f.read(block_size)
+            buffer = buffer[position:] + chunk
+            position = 0
+
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+                    if buffer[position] == '[':
+                        if started:
+                            break
+
+                        started = True
+
+                    position += 1
+
+                if position < len(buffer) and buffer[position] == ']':
+                    return
+
+                if position >= len(buffer):
+                    break
+
+                try:
+                    obj, end = decoder.raw_decode(buffer, position)
+
+                except json.JSONDecodeError:
+                    if not chunk:
+                        raise
 
-def download(url):
-    response = requests.get(url)
-    response.raise_for_status()
+                    break
 
-    return response.content
+                if end == len(buffer) and chunk:
+                    break
 
+                position = end
+
+                yield obj
+
+            if not chunk:
+                raise ValueError('Unexpected end of JSON array: %s' % path)
+
+
+def download_file(url, path, digest=None):
+    part_path = path + '.part'
+    meta_path = path + '.part.json'
+
+    hash_object = hashlib.md5()
+    offset = 0
+    validator = None
+
+    if os.path.exists(part_path) and os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            try:
+                meta = json.load(f)
+
+            except ValueError:
+                meta = {}
+
+        if meta.get('url') == url and meta.get('md5') == digest and (digest is not None or meta.get('validator')):
+            validator = meta.get('validator')
+
+            with open(part_path, 'rb') as f:
+                while data := f.read(block_size):
+                    hash_object.update(data)
+                    offset += len(data)
+
+            count('bytes_read', offset)
+
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+
+        if validator:
+            headers['If-Range'] = validator
+
+    with measure('download'), limit(url), \
+            get_session().get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if offset and response.status_code == 416:
+            size = offset
+
+        else:
+            response.raise_for_status()
+
+            if offset and (response.status_code != 206 or not response.headers.get('Content-Range', '').startswith(
+                    'bytes %d-' % offset)):
+                hash_object = hashlib.md5()
+                offset = 0
+
+            size = None
+            if response.headers.get('Content-Length') and not response.headers.get('Content-Encoding'):
+                size = offset + int(response.headers['Content-Length'])
+
+            validator = response.headers.get('ETag')
+            if not validator or validator.startswith('W/'):
+                validator = response.headers.get('Last-Modified')
+
+            with open(meta_path + '.tmp', 'w') as f:
+                json.dump({'url': url, 'md5': digest, 'size': size, 'validator': validator}, f)
+
+            os.replace(meta_path + '.tmp', meta_path)
+
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                for data in response.iter_content(block_size):
+                    hash_object.update(data)
+                    f.write(data)
+
+                    count('bytes_fetched', len(data))
+                    count('bytes_written', len(data))
+
+    if size is not None and os.path.getsize(part_path) != size:
+        raise IOError('Incomplete download: %s' % url)
+
+    os.remove(meta_path)
+
+    if digest is not None and hash_object.hexdigest() != digest.lower():
+        os.remove(part_path)
+
+        raise ValueError('MD5 mismatch: %s != %s' % (hash_object.hexdigest(), digest))
+
+    release(path)
+
+    os.replace(part_path, path)
+
+    return hash_object.hexdigest()
+
+
+@contextlib.contextmanager
+def store_lock():
+    with store_thread_lock:
+        lock_path = store_directory + '/.lock'
+
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > 60:
+                        os.remove(lock_path)
+
+                except FileNotFoundError:
+                    pass
+
+                time.sleep(0.05)
+
+        done = threading.Event()
+
+        threading.Thread(target=heartbeat, args=(lock_path, done), daemon=True).start()
+
+        try:
+            if os.path.exists(store_directory + '/index.json'):
+                with open(store_directory + '/index.json', 'r') as f:
+                    index = json.load(f)
+
+            else:
+                index = {}
+
+            yield index
+
+            with open(store_directory + '/index.json.tmp', 'w') as f:
+                json.dump(index, f)
+
+            os.replace(store_directory + '/index.json.tmp', store_directory + '/index.json')
+
+        finally:
+            done.set()
+
+            os.close(fd)
+            os.remove(lock_path)
+
+
+def heartbeat(lock_path, done):
+    while not done.wait(10):
+        try:
+            os.utime(lock_path)
+
+        except OSError:
+            pass
+
+
+def store_path(digest):
+    return store_directory + '/' + digest[:2] + '/' + digest + '.zip'
+
+
+def store_link(source, destination):
+    try:
+        os.link(source, destination + '.tmp')
+
+    except OSError:
+        shutil.copyfile(source, destination + '.tmp')
+
+    release(destination)
+
+    os.replace(destination + '.tmp', destination)
+
+
+def store_get(digest, path):
+    if store_directory is None:
+        return False
+
+    digest = digest.lower()
+
+    with store_lock() as index:
+        if digest not in index or not os.path.exists(store_path(digest)):
+            index.pop(digest, None)
+
+            return False
+
+        store_link(store_path(digest), path)
+
+        count('store_hits')
+
+        entry = index[digest]
+        entry['used'] = time.time()
+        if os.getcwd() not in entry['refs']:
+            entry['refs'].append(os.getcwd())
+
+    return True
+
+
+def store_put(digest, path):
+    if store_directory is None:
+        return
+
+    digest = digest.lower()
+
+    with store_lock() as index:
+        if not os.path.exists(store_path(digest)):
+            os.makedirs(os.path.dirname(store_path(digest)), exist_ok=True)
+
+            store_link(path, store_path(digest))
+
+        entry = index.setdefault(digest, {'size': os.path.getsize(path), 'refs': []})
+        entry['used'] = time.time()
+        if os.getcwd() not in entry['refs']:
+            entry['refs'].append(os.getcwd())
+
+        evict(index)
+
+
+def store_release(digests):
+    if store_directory is None:
+        return
+
+    digests = {digest.lower() for digest in digests}
+
+    with store_lock() as index:
+        for digest, entry in index.items():
+            if digest not in digests and os.getcwd() in entry['refs']:
+                entry['refs'].remove(os.getcwd())
+
+        evict(index)
+
+
+def evict(index):
+    if not store_limit:
+        return
+
+    total = sum(entry['size'] for entry in index.values())
+
+    for digest, entry in sorted(index.items(), key=lambda item: item[1]['used']):
+        if total <= store_limit:
+            break
+
+        if entry['refs']:
+            continue
+
+        if os.path.exists(store_path(digest)):
+            os.remove(store_path(digest))
+
+        del index[digest]
+
+        total -= entry['size']
+
+
+def signature(path):
+    stat = os.stat(path)
+
+    count('files_stated')
+
+    return '%d:%d:%d' % (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def md5(path, known=None):
+    if known is not None and not verify:
+        known_signature, known_digest = known
+
+        if known_signature and known_digest and known_signature == signature(path):
+            count('md5_skipped')
+
+            return known_digest
 
-def md5(path):
     hash_object = hashlib.md5()
 
     with open(path, 'rb') as f:
         while data := f.read(block_size):
             hash_object.update(data)
 
+            count('bytes_read', len(data))
+
     return hash_object.hexdigest()
@@ -1,16 +1,33 @@
 #!/usr/bin/python3
 
-import concurrent.futures
-import datetime
+import json
 import math
 import os
 import re
 import shutil
-import subprocess
+import threading
 import time
 import zipfile
 import zlib
 
+from func import archive, count, measure
+
+try:
+    import fcntl
+
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409
+
+backends = {}
+counters = {}
+counters_lock = threading.Lock()
+
+timestamps = {}
+
+manifests = {}
+
 
 class Info:
     def __init__(self):
@@ -19,6 +36,161 @@ class Info:
         self.size = None
         self.crc32 = None
         self.modified = None
+        self.modified_ns = None
+
+
+def copy_hardlink(source, destination):
+    os.link(source, destination)
+
+    return os.path.getsize(destination)
+
+
+def copy_reflink(source, destination):
+    if fcntl is None:
+        raise OSError('FICLONE is not available')
+
+    with open(source, 'rb') as f1, open(destination, 'wb') as f2:
+        fcntl.ioctl(f2.fileno(), FICLONE, f1.fileno())
+
+        return os.fstat(f2.fileno()).st_size
+
+
+def copy_range(source, destination):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError('copy_file_range is not available')
+
+    return copy_kernel(source, destination, os.copy_file_range)
+
+
+def copy_sendfile(source, destination):
+    if not hasattr(os, 'sendfile'):
+        raise OSError('sendfile is not available')
+
+    return copy_kernel(source, destination, lambda fd1, fd2, size: os.sendfile(fd2, fd1, None, size))
+
+
+def copy_kernel(source, destination, function):
+    with open(source, 'rb') as f1, open(destination, 'wb') as f2:
+        size = os.fstat(f1.fileno()).st_size
+        copied = 0
+
+        while copied < size:
+            sent = function(f1.fileno(), f2.fileno(), size - copied)
+            if sent == 0:
+                break
+
+            copied += sent
+
+        return copied
+
+
+def copy_plain(source, destination):
+    shutil.copyfile(source, destination)
+
+    return os.path.getsize(destination)
+
+
+def copy(source, destination, hardlink=False, key=None):
+    chain = [copy_reflink, copy_range, copy_sendfile, copy_plain]
+    if hardlink:
+        chain.insert(0, copy_hardlink)
+
+    if key in backends and backends[key] in chain:
+        chain = chain[chain.index(backends[key]):]
+
+    for backend in chain:
+        start_time = time.perf_counter()
+
+        try:
+            size = backend(source, destination)
+
+        except OSError:
+            if backend is chain[-1]:
+                raise
+
+            if os.path.lexists(destination):
+                os.remove(destination)
+
+            continue
+
+        count('bytes_written', size)
+
+        with counters_lock:
+            backends[key] = backend
+
+            counter = counters.setdefault(backend.__name__.removeprefix('copy_'), {'files': 0, 'bytes': 0, 'time': 0})
+            counter['files'] += 1
+            counter['bytes'] += size
+            counter['time'] += time.perf_counter() - start_time
+
+        return
+
+
+def timestamp(date_time):
+    result = timestamps.get(date_time)
+
+    if result is None:
+        result = timestamps[date_time] = int(time.mktime(date_time + (0, 0, -1)))
+
+    return result
+
+
+def copies():
+    with counters_lock:
+        return {name: dict(counter) for name, counter in counters.items()}
+
+
+class Matcher:
+    def __init__(self, patterns):
+        self.trie = None
+        self.compiled_pattern = None
+        self.compiled_patterns = None
+
+        literals = []
+
+        for pattern in patterns:
+            if not re.fullmatch(r'\^(?:\\\W|[^.^$*+?{}\[\]\\|()])*', pattern):
+                break
+
+            literals.append(re.sub(r'\\(.)', r'\1', pattern[1:]))
+
+        else:
+            self.trie = {}
+
+            for literal in literals:
+                node = self.trie
+                for char in literal:
+                    node = node.setdefault(char, {})
+
+                node[None] = True
+
+            return
+
+        compiled_patterns = [re.compile(pattern) for pattern in patterns]
+
+        if all(x.groups == 0 and x.flags == re.compile('').flags for x in compiled_patterns):
+            self.compiled_pattern = re.compile('|'.join('(?:%s)' % pattern for pattern in patterns))
+
+        else:
+            self.compiled_patterns = compiled_patterns
+
+    def search(self, path):
+        if self.compiled_pattern is not None:
+            return self.compiled_pattern.search(path) is not None
+
+        if self.compiled_patterns is not None:
+            return any(x.search(path) for x in self.compiled_patterns)
+
+        node = self.trie
+        for char in path:
+            if None in node:
+                return True
+
+            node = node.get(char)
+            if node is None:
+                return False
+
+        return None in node
 
 
 class Sync:
@@ -28,45 +200,58 @@ class Sync:
         self.clean = True
         self.compare = True
         self.checksums = False
+        self.cached_checksums = False
         self.check_time = True
         self.restore_time = True
         self.force_restore = False
+        self.staging = False
         self.reflink = False
+        self.hardlink = False
         self.dry_run = False
         self.verbose = True
         self.include_patterns = []
         self.exclude_patterns = []
+        self.exclude_paths = set()
+        self.manifest = None
+        self.trust_manifest = True
         self.threads = os.cpu_count()
         self.block_size = 512 * 1024
 
-        self.__skip_cache = set()
-        self.__compiled_include_patterns = []
-        self.__compiled_exclude_patterns = []
+        self.__skip_cache = {}
+        self.__include_matcher = None
+        self.__exclude_matcher = None
 
     def perform(self):
         self.__skip_cache.clear()
 
-        for pattern in self.include_patterns:
-            self.__compiled_include_patterns.append(re.compile(pattern))
-
-        for pattern in self.exclude_patterns:
-            self.__compiled_exclude_patterns.append(re.compile(pattern))
+        self.__include_matcher = Matcher(self.include_patterns) if self.include_patterns else None
+        self.__exclude_matcher = Matcher(self.exclude_patterns) if self.exclude_patterns else None
 
         if not self.dry_run:
             os.makedirs(self.destination, exist_ok=True)
 
         l_list = {}
-        r_list = self.__tree(self.destination)
 
-        if type(self.sources) is str:
-            self.sources = [self.sources]
+        with measure('sync.tree'):
+            data = self.__read()
+
+            state = self.__load(data)
+            if state is None:
+                state = self.__tree(self.destination, skip=False)
 
-        for source in self.sources:
-            if not os.path.exists(source):
-                print(source, 'not found')
-                return
+                self.__restore_checksums(state, data)
 
-            l_list |= self.__tree(source)
+            r_list = self.__filter(state)
+
+            if type(self.sources) is str:
+                self.sources = [self.sources]
+
+            for source in self.sources:
+                if not os.path.exists(source):
+                    print(source, 'not found')
+                    return
+
+                l_list |= self.__tree(source)
 
         excess = r_list.keys() - l_list.keys()
         updated = l_list.keys() - r_list.keys()
@@ -85,9 +270,11 @@ class Sync:
                     if l_info.size == r_info.size:
                         if not self.check_time or l_info.modified == r_info.modified:
                             if self.compare:
-                                comparable.append((path, l_info,))
+                                comparable.append((path, l_info, r_info,))
 
                         else:
+                            import datetime
+
                             l_modified = datetime.datetime.fromtimestamp(l_info.modified)
                             r_modified = datetime.datetime.fromtimestamp(r_info.modified)
 
@@ -104,141 +291,321 @@ class Sync:
 
             comparable = sorted(comparable, key=lambda x: x[1].size, reverse=True)
 
-            if self.threads > 1:
-                chunk_size = math.ceil(len(comparable) / self.threads) or 1
-                chunk_cnt = math.ceil(len(comparable) / chunk_size)
-                chunks = [comparable[i::chunk_cnt] for i in range(chunk_cnt)]
+            with measure('sync.compare'):
+                if self.threads > 1:
+                    chunk_size = math.ceil(len(comparable) / self.threads) or 1
+                    chunk_cnt = math.ceil(len(comparable) / chunk_size)
+                    chunks = [comparable[i::chunk_cnt] for i in range(chunk_cnt)]
 
-                with concurrent.futures.ThreadPoolExecutor(self.threads) as executor:
-                    futures = [executor.submit(self.__compare, chunk) for chunk in chunks]
-                    for future in futures:
-                        updated.update(future.result())
+                    import concurrent.futures
 
-            else:
-                updated.update(self.__compare(comparable))
+                    with concurrent.futures.ThreadPoolExecutor(self.threads) as executor:
+                        futures = [executor.submit(self.__compare, chunk) for chunk in chunks]
+                        for future in futures:
+                            updated.update(future.result())
+
+                else:
+                    updated.update(self.__compare(comparable))
 
         else:
             updated = updated.union(exists)
 
+        deleted = []
+
         if self.clean:
             for path in sorted(excess, reverse=True):
-                if self.__skip(path):
+                if not self.__skip(path):
+                    deleted.append(path)
+
+        staged = set()
+
+        if self.staging and not self.dry_run:
+            for path in updated.union(deleted):
+                folder = path.split('/', 1)[0] + '/'
+
+                if folder != path and folder in l_list:
+                    staged.add(folder)
+
+        for path in deleted:
+            if not self.dry_run and path.split('/', 1)[0] + '/' not in staged:
+                if not path.endswith('/'):
+                    os.remove(self.destination + '/' + path)
+
+                else:
+                    os.rmdir(self.destination + '/' + path)
+
+            if self.verbose:
+                print('deleted:', path)
+
+        if not self.dry_run:
+            groups = {}
+
+            for path in sorted(updated):
+                if path.split('/', 1)[0] + '/' in staged:
                     continue
 
-                if not self.dry_run:
-                    if not path.endswith('/'):
-                        os.remove(self.destination + '/' + path)
+                if path.endswith('/'):
+                    if path not in exists:
+                        os.makedirs(self.destination + '/' + path)
 
-                    else:
-                        os.rmdir(self.destination + '/' + path)
+                else:
+                    l_info = l_list[path]
 
-                if self.verbose:
-                    print('deleted:', path)
+                    groups.setdefault((l_info.source, l_info.is_zip_file), []).append(path)
 
-        zip_files = {}
+            with measure('sync.write'):
+                self.__write_groups(groups, self.destination)
 
-        reflink_path = os.path.dirname(__file__) + '/reflink.exe'
+                if staged:
+                    self.__stage(staged, l_list, state, updated, deleted)
 
         for path in sorted(updated):
             if path.endswith('/'):
                 if path not in exists:
-                    if not self.dry_run:
-                        os.makedirs(self.destination + '/' + path)
+                    print('created:', path)
+
+            elif self.verbose:
+                if path in exists:
+                    print('updated:', path)
 
+                else:
                     print('created:', path)
 
-            else:
-                if not self.dry_run:
+        restored = set()
+
+        if not self.dry_run and self.restore_time:
+            for path in sorted(l_list.keys()):
+                if not path.endswith('/'):
                     l_info = l_list[path]
 
-                    if os.path.exists(self.destination + '/' + path):
-                        os.remove(self.destination + '/' + path)
+                    if path in updated or l_info.modified != r_list[path].modified:
+                        os.utime(self.destination + '/' + path, (l_info.modified, l_info.modified))
+
+                        restored.add(path)
 
-                    if l_info.is_zip_file:
-                        if l_info.source not in zip_files:
-                            zip_files[l_info.source] = zipfile.ZipFile(l_info.source)
+                        if self.verbose:
+                            print('restored modified time:', path)
 
-                        zip_file = zip_files[l_info.source]
+        if not self.dry_run and self.manifest:
+            for path in deleted:
+                del state[path]
 
-                        f1 = zip_file.open(path)
-                        f2 = open(self.destination + '/' + path, 'wb')
+            for path in l_list.keys():
+                if path in updated or path in restored:
+                    info = Info()
 
-                        while data := f1.read(self.block_size):
-                            f2.write(data)
+                    if not path.endswith('/'):
+                        stat = os.stat(self.destination + '/' + path)
 
-                        f1.close()
-                        f2.close()
-                    else:
-                        if not self.reflink:
-                            shutil.copyfile(l_info.source + '/' + path, self.destination + '/' + path)
+                        count('files_stated')
 
-                        else:
-                            subprocess.call([reflink_path, l_info.source + '/' + path, self.destination + '/' + path])
+                        info.source = self.destination
+                        info.modified = int(stat.st_mtime)
+                        info.modified_ns = stat.st_mtime_ns
+                        info.size = stat.st_size
 
-                if self.verbose:
-                    if path in exists:
-                        print('updated:', path)
+                    state[path] = info
 
-                    else:
-                        print('created:', path)
+                if l_list[path].crc32 is not None:
+                    state[path].crc32 = l_list[path].crc32
 
-        if not self.dry_run and self.restore_time:
-            r_list = self.__tree(self.destination)
+            self.__save(state)
+
+    def __stage(self, folders, l_list, state, updated, deleted):
+        staging = self.destination.rstrip('/') + '.staging'
+
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+
+        os.makedirs(staging + '/new')
+        os.makedirs(staging + '/old')
+
+        groups = {}
+
+        for folder in sorted(folders):
+            paths = {path for path in state.keys() if path.startswith(folder)}
+            paths = paths.difference(deleted)
+            paths = paths.union(path for path in updated if path.startswith(folder))
+
+            for path in sorted(paths):
+                if path.endswith('/'):
+                    os.makedirs(staging + '/new/' + path, exist_ok=True)
 
-            for path in r_list.keys():
-                if not path.endswith('/') and path in l_list:
+                elif path in updated:
                     l_info = l_list[path]
-                    r_info = r_list[path]
 
-                    if l_info.modified != r_info.modified:
-                        os.utime(self.destination + '/' + path, (l_info.modified, l_info.modified))
+                    groups.setdefault((l_info.source, l_info.is_zip_file), []).append(path)
 
-                        if self.verbose:
-                            print('restored modified time:', path)
+                else:
+                    try:
+                        os.link(self.destination + '/' + path, staging + '/new/' + path)
 
-    def __compare(self, comparable):
-        updated = set()
+                    except OSError:
+                        shutil.copy2(self.destination + '/' + path, staging + '/new/' + path)
 
-        zip_files = {}
+        self.__write_groups(groups, staging + '/new')
 
-        for pair in comparable:
-            path, info = pair
+        for folder in sorted(folders):
+            name = folder.rstrip('/')
 
-            result = None
+            if os.path.exists(self.destination + '/' + name):
+                os.rename(self.destination + '/' + name, staging + '/old/' + name)
 
-            if info.is_zip_file:
-                if info.source not in zip_files:
-                    zip_files[info.source] = zipfile.ZipFile(info.source)
+            os.rename(staging + '/new/' + name, self.destination + '/' + name)
 
-                zip_file = zip_files[info.source]
+        shutil.rmtree(staging)
 
-                f1 = None
-                if not self.checksums:
-                    f1 = zip_file.open(path)
+    def __write_groups(self, groups, destination):
+        if self.threads > 1 and len(groups) > 1:
+            import concurrent.futures
 
-            else:
-                f1 = open(info.source + '/' + path, 'rb')
+            with concurrent.futures.ThreadPoolExecutor(self.threads) as executor:
+                futures = [executor.submit(self.__write, *key, paths, destination) for key, paths in groups.items()]
+                for future in futures:
+                    future.result()
+
+        else:
+            for key, paths in groups.items():
+                self.__write(*key, paths, destination)
 
-            f2 = open(self.destination + '/' + path, 'rb')
+    def __write(self, source, is_zip_file, paths, destination):
+        reflink_path = os.path.dirname(__file__) + '/reflink.exe'
 
-            crc32 = 0
-            while r_data := f2.read(self.block_size):
-                if info.is_zip_file and self.checksums:
-                    crc32 = zlib.crc32(r_data, crc32)
+        zip_file = archive(source).zip_file if is_zip_file else None
 
-                else:
-                    l_data = f1.read(self.block_size)
-                    if l_data != r_data:
-                        result = 'mismatch:', path
-                        break
+        for path in paths:
+            if os.path.exists(destination + '/' + path):
+                os.remove(destination + '/' + path)
 
-            if self.checksums and info.crc32 is not None and info.crc32 != crc32:
-                result = 'crc32:', path, info.crc32, '!=', crc32
+            if zip_file is not None:
+                f1 = zip_file.open(path)
+                f2 = open(destination + '/' + path, 'wb')
+
+                while data := f1.read(self.block_size):
+                    f2.write(data)
+
+                    count('bytes_written', len(data))
 
-            if f1 is not None:
                 f1.close()
+                f2.close()
+            else:
+                if self.reflink and os.name == 'nt':
+                    import subprocess
+
+                    subprocess.call([reflink_path, source + '/' + path, destination + '/' + path])
 
-            f2.close()
+                else:
+                    copy(source + '/' + path, destination + '/' + path, self.hardlink, (source, destination))
+
+    def __read(self):
+        if not self.manifest or not self.trust_manifest or not os.path.exists(self.manifest):
+            return None
+
+        stat = os.stat(self.manifest)
+        key = stat.st_size, stat.st_mtime_ns
+
+        if self.manifest in manifests and manifests[self.manifest][0] == key:
+            data = manifests[self.manifest][1]
+
+        else:
+            with open(self.manifest, 'r') as f:
+                data = json.load(f)
+
+            manifests[self.manifest] = key, data
+
+        if data.get('destination') != self.destination:
+            return None
+
+        return data
+
+    def __load(self, data):
+        if data is None:
+            return None
+
+        count('files_stated', len(data['directories']))
+
+        for path, modified in data['directories'].items():
+            try:
+                if os.stat(self.destination + '/' + path).st_mtime_ns != modified:
+                    return None
+
+            except OSError:
+                return None
+
+        result = {}
+
+        for path in data['directories'].keys():
+            if path:
+                result[path] = Info()
+
+        for path, (size, modified, modified_ns, crc32) in data['files'].items():
+            info = Info()
+            info.source = self.destination
+            info.modified = modified
+            info.modified_ns = modified_ns
+            info.size = size
+            info.crc32 = crc32
+
+            result[path] = info
+
+        return result
+
+    @staticmethod
+    def __restore_checksums(state, data):
+        if data is None:
+            return
+
+        for path, (size, modified, modified_ns, crc32) in data['files'].items():
+            info = state.get(path)
+
+            if info is not None and info.size == size and info.modified_ns == modified_ns:
+                info.crc32 = crc32
+
+    def __save(self, state):
+        data = {
+            'destination': self.destination,
+            'directories': {},
+            'files': {},
+        }
+
+        for path in [''] + sorted(state.keys()):
+            if path.endswith('/') or not path:
+                data['directories'][path] = os.stat(self.destination + '/' + path).st_mtime_ns
+
+                count('files_stated')
+
+            else:
+                info = state[path]
+                data['files'][path] = [info.size, info.modified, info.modified_ns, info.crc32]
+
+        with open(self.manifest + '.tmp', 'w') as f:
+            json.dump(data, f)
+
+        os.replace(self.manifest + '.tmp', self.manifest)
+
+        stat = os.stat(self.manifest)
+        manifests[self.manifest] = (stat.st_size, stat.st_mtime_ns), data
+
+    def __filter(self, tree):
+        result = {}
+
+        for path, info in tree.items():
+            if not self.__skip(path):
+                result[path] = info
+
+        self.__parents(result)
+
+        return result
+
+    def __compare(self, comparable):
+        updated = set()
+
+        for path, l_info, r_info in comparable:
+            if l_info.is_zip_file and self.cached_checksums and l_info.crc32 is not None:
+                result = self.__compare_checksums(path, l_info, r_info)
+
+            else:
+                result = self.__compare_contents(path, l_info)
 
             if result:
                 updated.add(path)
@@ -248,92 +615,190 @@ class Sync:
 
         return updated
 
-    def __tree(self, source):
+    def __compare_checksums(self, path, l_info, r_info):
+        if r_info.crc32 is None:
+            crc32 = 0
+
+            with open(self.destination + '/' + path, 'rb') as f:
+                while data := f.read(self.block_size):
+                    crc32 = zlib.crc32(data, crc32)
+
+                    count('bytes_read', len(data))
+
+            r_info.crc32 = crc32
+
+        if l_info.crc32 != r_info.crc32:
+            return 'crc32:', path, l_info.crc32, '!=', r_info.crc32
+
+        return None
+
+    def __compare_contents(self, path, info):
+        result = None
+
+        if info.is_zip_file:
+            f1 = None
+            if not self.checksums:
+                f1 = archive(info.source).zip_file.open(path)
+
+        else:
+            f1 = open(info.source + '/' + path, 'rb')
+
+        f2 = open(self.destination + '/' + path, 'rb')
+
+        crc32 = 0
+        while r_data := f2.read(self.block_size):
+            count('bytes_read', len(r_data) * (1 if f1 is None else 2))
+
+            if info.is_zip_file and self.checksums:
+                crc32 = zlib.crc32(r_data, crc32)
+
+            else:
+                l_data = f1.read(self.block_size)
+                if l_data != r_data:
+                    result = 'mismatch:', path
+                    break
+
+        if self.checksums and info.crc32 is not None and info.crc32 != crc32:
+            result = 'crc32:', path, info.crc32, '!=', crc32
+
+        if f1 is not None:
+            f1.close()
+
+        f2.close()
+
+        return result
+
+    def __tree(self, source, skip=True):
         if source == '':
             return {}
 
         if not os.path.exists(source):
             return {}
 
-        cut = len(source) + 1
-
         result = {}
 
         if os.path.isfile(source):
-            if zipfile.is_zipfile(source):
-                z = zipfile.ZipFile(source)
+            try:
+                a = archive(source)
 
-                for name in sorted(z.namelist()):
-                    i = z.getinfo(name)
+            except zipfile.BadZipFile:
+                a = None
 
+            if a is not None:
+                for i in sorted(a.infos, key=lambda x: x.filename):
                     info = Info()
 
                     path = i.filename.rstrip('/')
                     if i.is_dir():
                         path += '/'
 
-                        if self.__skip(path):
+                        if skip and self.__skip(path):
                             continue
 
                     else:
-                        if self.__skip(path):
+                        if skip and self.__skip(path):
                             continue
 
-                        modified_str = '%d-%02d-%02d %02d:%02d:%02d' % i.date_time
-                        modified_datetime = datetime.datetime.strptime(modified_str, '%Y-%m-%d %H:%M:%S')
-                        modified_timestamp = time.mktime(modified_datetime.timetuple())
-
                         info.source = source
                         info.is_zip_file = True
-                        info.modified = int(modified_timestamp)
+                        info.modified = timestamp(i.date_time)
                         info.size = i.file_size
                         info.crc32 = i.CRC
 
                     result[path] = info
 
+                self.__parents(result)
+
             else:
                 path = os.path.basename(source)
 
-                if self.__skip(path):
+                if skip and self.__skip(path):
                     return result
 
+                stat = os.stat(source)
+
+                count('files_stated')
+
                 info = Info()
                 info.source = os.path.dirname(source)
-                info.modified = int(os.path.getmtime(source))
-                info.size = os.path.getsize(source)
+                info.modified = int(stat.st_mtime)
+                info.modified_ns = stat.st_mtime_ns
+                info.size = stat.st_size
 
                 result[path] = info
 
         else:
-            for dir_path, dir_names, file_names in os.walk(source):
-                dir_path = dir_path.replace(os.sep, '/')
-                short_path = dir_path[cut:]
-                if short_path:
-                    short_path += '/'
+            entries = self.__scan(source, source, '', skip, result)
 
-                for dir_name in sorted(dir_names):
-                    path = short_path + dir_name + '/'
+            if self.threads > 1 and len(entries) > 1:
+                import concurrent.futures
 
-                    if self.__skip(path):
-                        continue
+                with concurrent.futures.ThreadPoolExecutor(self.threads) as executor:
+                    futures = [executor.submit(self.__scan_directory, source, entry, skip) for entry in entries]
+                    for entry, future in zip(entries, futures):
+                        self.__merge(result, entry, future.result(), skip)
 
-                    info = Info()
+            else:
+                for entry in entries:
+                    self.__merge(result, entry, self.__scan_directory(source, entry, skip), skip)
 
-                    result[path] = info
+        return result
 
-                for file_name in sorted(file_names):
-                    path = short_path + file_name
+    def __scan_directory(self, source, entry, skip):
+        result = {}
 
-                    if self.__skip(path):
-                        continue
+        for child in self.__scan(source, entry[0], entry[1], skip, result):
+            self.__merge(result, child, self.__scan_directory(source, child, skip), skip)
 
-                    info = Info()
-                    info.source = source
-                    info.modified = int(os.path.getmtime(dir_path + '/' + file_name))
-                    info.size = os.path.getsize(dir_path + '/' + file_name)
+        return result
 
-                    result[path] = info
+    def __scan(self, source, dir_path, short_path, skip, result):
+        directories = []
+
+        with os.scandir(dir_path) as iterator:
+            entries = sorted(iterator, key=lambda x: x.name)
+
+        for entry in entries:
+            if entry.is_dir():
+                path = short_path + entry.name + '/'
+
+                if not entry.is_symlink():
+                    directories.append((dir_path + '/' + entry.name, path))
+
+                else:
+                    if not skip or not self.__skip(path):
+                        result[path] = Info()
+
+            else:
+                path = short_path + entry.name
+
+                if skip and self.__skip(path):
+                    continue
+
+                stat = entry.stat()
 
+                count('files_stated')
+
+                info = Info()
+                info.source = source
+                info.modified = int(stat.st_mtime)
+                info.modified_ns = stat.st_mtime_ns
+                info.size = stat.st_size
+
+                result[path] = info
+
+        return directories
+
+    def __merge(self, result, entry, children, skip):
+        path = entry[1]
+
+        if children or not skip or not self.__skip(path):
+            result[path] = Info()
+
+        result |= children
+
+    @staticmethod
+    def __parents(result):
         for path in sorted(result.keys()):
             while True:
                 path = os.path.dirname(path.rstrip('/')) + '/'
@@ -346,29 +811,20 @@ class Sync:
 
                     result[path] = info
 
-        return result
-
     def __skip(self, path):
         if path in self.__skip_cache:
-            return True
+            return self.__skip_cache[path]
 
-        result = True
+        if path in self.exclude_paths:
+            result = True
 
-        for compiled_pattern in self.__compiled_include_patterns:
-            if compiled_pattern.findall(path):
-                result = False
-                break
-
-        if result:
+        elif self.__include_matcher is not None and self.__include_matcher.search(path):
             result = False
 
-            for compiled_pattern in self.__compiled_exclude_patterns:
-                if compiled_pattern.findall(path):
-                    result = True
-                    break
+        else:
+            result = self.__exclude_matcher is not None and self.__exclude_matcher.search(path)
 
-        if result:
-            self.__skip_cache.add(path)
+        self.__skip_cache[path] = result
 
         return result
 
@@ -383,4 +839,5 @@ def sync(sources, destination, **kwargs):
         getattr(task, key.lstrip('_'))
         setattr(task, key.lstrip('_'), kwargs[key])
 
-    task.perform()
+    with measure('sync'):
+        task.perform()